@@ -0,0 +1,183 @@
+import logging
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+import psycopg2
+
+_log = logging.getLogger(__name__)
+_log.setLevel(logging.WARN)
+
+ScopeStats = namedtuple('ScopeStats', ['depth', 'location', 'total', 'lock_wait', 'by_category',
+                                       'blocked_on'])
+
+_SAMPLE_SQL = '''
+    SELECT a.pid, a.state, a.wait_event_type, a.wait_event,
+           l.locktype, l.mode, l.relation::regclass::text, pg_blocking_pids(a.pid)
+    FROM pg_stat_activity a
+    LEFT JOIN pg_locks l ON l.pid = a.pid AND NOT l.granted
+    WHERE a.pid = ANY(%s)
+'''
+
+
+class LockWaitProfiler(object):
+    """
+    Sampling profiler attributing database wait time to the innermost active Transaction scope.
+
+    While running, a background thread polls pg_stat_activity and pg_locks over a separate
+    monitoring connection for the backends of all profiled Transactions, and attributes the time
+    between samples to the innermost active scope on each connection, identified by its nesting
+    depth and the source location where it was entered.
+
+    Usage:
+        with LockWaitProfiler(dsn) as profiler:
+            with Transaction(cxn, profiler=profiler):
+                # do stuff
+        print(profiler.report())
+
+    Time is categorised by the backend's wait event type (e.g. 'Lock', 'IO', 'LWLock'), with
+    'CPU' for a backend executing without waiting, and 'Client' for a backend idle in
+    transaction, i.e. waiting on client-side Python code.
+    """
+
+    def __init__(self, dsn=None, interval=0.01, **connect_kwargs):
+        """
+        :param dsn, connect_kwargs: Passed to psycopg2.connect() to open the monitoring
+                                    connection.
+        :param interval: Seconds between samples.
+        """
+        self.interval = interval
+        self._connect_args = (dsn,), connect_kwargs
+        self._lock = threading.Lock()
+        self._backends = {}  # backend pid -> active Transaction stack
+        self._stats = defaultdict(_ScopeAccumulator)  # (depth, location) -> _ScopeAccumulator
+        self._thread = None
+        self._stopping = threading.Event()
+        self.error = None  # Exception which stopped sampling early, if any
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        if self._thread is not None:
+            raise Exception('Profiler already started.')
+        args, kwargs = self._connect_args
+        monitor_cxn = psycopg2.connect(*args, **kwargs)
+        monitor_cxn.autocommit = True  # pg_stat_activity is otherwise snapshotted per transaction
+        self._stopping.clear()
+        self.error = None
+        self._thread = threading.Thread(target=self._run, args=(monitor_cxn,),
+                                        name='LockWaitProfiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def register(self, cxn, transaction_stack):
+        """Start sampling `cxn`, attributing samples to the innermost of `transaction_stack`."""
+        with self._lock:
+            self._backends[cxn.get_backend_pid()] = transaction_stack
+
+    def unregister(self, cxn):
+        with self._lock:
+            self._backends.pop(cxn.get_backend_pid(), None)
+
+    def stats(self):
+        """
+        Return a list of ScopeStats, in descending order of time spent waiting on locks.
+
+        If sampling failed, these only cover the time up to the failure; see `error`.
+        """
+        with self._lock:
+            stats = [acc.freeze(depth, location)
+                     for (depth, location), acc in self._stats.items()]
+        return sorted(stats, key=lambda s: (s.lock_wait, s.total), reverse=True)
+
+    def report(self, limit=10):
+        """Return a human-readable report of the `limit` scopes which spent most time blocked."""
+        lines = []
+        if self.error is not None:
+            lines.append('INCOMPLETE: sampling stopped early after error: {!r}'.format(self.error))
+        for s in self.stats()[:limit]:
+            lines.append('{:.3f}s blocked of {:.3f}s sampled: depth {} entered at {}'.format(
+                s.lock_wait, s.total, s.depth, s.location))
+            categories = sorted(s.by_category.items(), key=lambda item: item[1], reverse=True)
+            lines.append('    ' + ', '.join('{} {:.3f}s'.format(category, seconds)
+                                            for category, seconds in categories))
+            blocked_on = sorted(s.blocked_on.items(), key=lambda item: item[1], reverse=True)
+            for description, seconds in blocked_on:
+                lines.append('    {:.3f}s waiting for {}'.format(seconds, description))
+        return '\n'.join(lines)
+
+    def _run(self, monitor_cxn):
+        try:
+            last_sample = time.time()
+            while not self._stopping.wait(self.interval):
+                now = time.time()
+                self._sample(monitor_cxn, now - last_sample)
+                last_sample = now
+        except Exception as e:
+            _log.exception('Profiler sampling failed; no further samples will be taken.')
+            self.error = e
+        finally:
+            monitor_cxn.close()
+
+    def _sample(self, monitor_cxn, elapsed):
+        with self._lock:
+            backends = dict(self._backends)
+        if not backends:
+            return
+
+        with monitor_cxn.cursor() as cur:
+            cur.execute(_SAMPLE_SQL, (list(backends),))
+            rows = cur.fetchall()
+
+        with self._lock:
+            for pid, state, wait_event_type, wait_event, locktype, mode, relation, blockers in rows:
+                try:
+                    scope = backends[pid][-1]
+                except IndexError:
+                    continue  # Outermost Transaction exited since the snapshot was taken
+
+                if wait_event_type is not None:
+                    category = wait_event_type
+                elif state is not None and state.startswith('idle in transaction'):
+                    category = 'Client'
+                else:
+                    category = 'CPU'
+
+                acc = self._stats[scope._depth, scope._entered_at]
+                acc.total += elapsed
+                acc.by_category[category] += elapsed
+                if wait_event_type == 'Lock':
+                    acc.blocked_on[_describe_lock(wait_event, locktype, mode, relation,
+                                                  blockers)] += elapsed
+
+
+class _ScopeAccumulator(object):
+    def __init__(self):
+        self.total = 0.0
+        self.by_category = defaultdict(float)
+        self.blocked_on = defaultdict(float)
+
+    def freeze(self, depth, location):
+        return ScopeStats(depth, location, self.total, self.by_category.get('Lock', 0.0),
+                          dict(self.by_category), dict(self.blocked_on))
+
+
+def _describe_lock(wait_event, locktype, mode, relation, blockers):
+    description = '{} {}'.format(mode or '?', locktype or wait_event)
+    if relation is not None:
+        description += ' on ' + relation
+    if blockers:
+        description += ' held by pid ' + ', '.join(str(pid) for pid in sorted(blockers))
+    return description
@@ -0,0 +1,194 @@
+import re
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+_IDENT = r'(?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?'
+_CLAUSE_KEYWORDS = (r'(?:WHERE|JOIN|INNER|LEFT|RIGHT|FULL|CROSS|NATURAL|ON|USING|GROUP|ORDER|'
+                    r'HAVING|LIMIT|OFFSET|FETCH|FOR|UNION|INTERSECT|EXCEPT|WINDOW)\b')
+_ALIAS = r'(?:\s+(?:AS\s+)?(?!{0})\w+)?'.format(_CLAUSE_KEYWORDS)
+_FROM_RE = re.compile(r'\b(?:FROM|JOIN)\b', re.IGNORECASE)
+_READ_TABLES_RE = re.compile(r'(?:FROM|JOIN)\s+((?:ONLY\s+)?{0}{1}(?:\s*,\s*(?:ONLY\s+)?{0}{1})*)'
+                             .format(_IDENT, _ALIAS), re.IGNORECASE)
+# What may follow a fully parsed FROM list or JOIN item
+_FROM_END_RE = re.compile(r'\s*(?:$|[);]|{0})'.format(_CLAUSE_KEYWORDS), re.IGNORECASE)
+_FROM_CLAUSE_TOKEN_RE = re.compile(r'[(),;]|\b(?:WHERE|GROUP|HAVING|ORDER|LIMIT|OFFSET|FETCH|FOR|'
+                                   r'UNION|INTERSECT|EXCEPT|WINDOW|RETURNING)\b', re.IGNORECASE)
+_WRITE_TABLES_RE = re.compile(r'\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|TRUNCATE(?:\s+TABLE)?)'
+                              r'(?:\s+ONLY)?\s+({0}(?:\s*,\s*{0})*)'.format(_IDENT),
+                              re.IGNORECASE)
+_TRUNCATE_CASCADE_RE = re.compile(r'\s*TRUNCATE\b.*\bCASCADE\b', re.IGNORECASE | re.DOTALL)
+_IDENT_RE = re.compile(_IDENT)
+_READ_STATEMENT_RE = re.compile(r'\s*(?:SELECT|WITH)\b', re.IGNORECASE)
+# Also matches row-locking clauses (FOR UPDATE/SHARE) and SELECT ... INTO
+_WRITE_KEYWORD_RE = re.compile(r'\b(?:INSERT|UPDATE|DELETE|TRUNCATE|MERGE|INTO|SHARE)\b',
+                               re.IGNORECASE)
+_CALL_RE = re.compile(r'(\w+)\s*\(')
+# Keywords which may precede a parenthesis, and functions and type names known to have no side
+# effects and to return the same result each time they are called within a transaction
+_PURE_CALLS = frozenset('''
+    all and any array as between by case else exists filter from having in is join lateral like
+    not on or over row select some then using values when where within
+    abs array_agg array_length avg bool_and bool_or btrim cardinality cast ceil ceiling char
+    char_length character coalesce concat concat_ws count date_part date_trunc decimal
+    dense_rank every extract first_value floor generate_series greatest jsonb_agg
+    jsonb_build_object json_agg json_build_object lag last_value lead least length lower ltrim
+    max min mod now nullif numeric position rank replace round row_number rtrim string_agg
+    substr substring sum time timestamp to_char to_date to_timestamp trim unnest upper varchar
+'''.split())
+
+
+class ReadCache(object):
+    """
+    LRU cache of read query results, scoped to a single outermost Transaction.
+
+    Each entry records the tables it was read from and the nesting depth of the Transaction
+    it was added in, so that it can be invalidated by writes to those tables, and discarded if
+    the Transaction it was added in is rolled back.
+    """
+
+    def __init__(self, maxsize):
+        """
+        :param maxsize: Maximum number of entries held before the least recently used entry is
+                        evicted.
+        """
+        if maxsize < 1:
+            raise ValueError('maxsize must be a positive integer, got {!r}'.format(maxsize))
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> _Entry
+
+    def get(self, key):
+        """Return the cached rows for `key`, or None if not cached."""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[key] = entry  # Re-insert as most recently used
+        self.hits += 1
+        return list(entry.rows)
+
+    def put(self, key, rows, tables, depth):
+        """
+        :param tables: Names of the tables the rows were read from, or None if unknown (in which
+                       case the entry is invalidated by a write to any table).
+        :param depth: Nesting depth of the Transaction the rows were read in.
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = _Entry(list(rows), tables, depth)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, tables=None):
+        """Drop entries read from any of `tables`, or all entries if `tables` is None."""
+        if tables is None:
+            self._entries.clear()
+            return
+        tables = set(tables)
+        self._drop(lambda entry: entry.tables is None or not tables.isdisjoint(entry.tables))
+
+    def discard(self, depth):
+        """Drop entries added at `depth` or deeper, as their Transaction has been rolled back."""
+        self._drop(lambda entry: entry.depth >= depth)
+
+    def release(self, depth):
+        """Hand entries added at `depth` or deeper over to the containing Transaction."""
+        for entry in self._entries.values():
+            if entry.depth >= depth:
+                entry.depth = depth - 1
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
+
+    def _drop(self, predicate):
+        for key in [k for k, entry in self._entries.items() if predicate(entry)]:
+            del self._entries[key]
+
+
+class _Entry(object):
+    __slots__ = ('rows', 'tables', 'depth')
+
+    def __init__(self, rows, tables, depth):
+        self.rows = rows
+        self.tables = tables
+        self.depth = depth
+
+
+def read_tables(sql):
+    """
+    Return the names of the tables referenced in FROM/JOIN clauses of `sql`, or None if they
+    cannot be determined, i.e. if any FROM/JOIN item is anything other than a plain table name
+    with an optional alias, such as a subquery or a function (which may read any table).
+    """
+    tables = set()
+    for keyword in _FROM_RE.finditer(sql):
+        match = _READ_TABLES_RE.match(sql, keyword.start())
+        if match is None or not _FROM_END_RE.match(sql, match.end()):
+            return None
+        names = _table_names(match.group(1))
+        if 'lateral' in names:
+            return None
+        if keyword.group(0).upper() == 'FROM' and _from_list_continues(sql, match.end()):
+            return None
+        tables.update(names)
+    return tables or None
+
+
+def _from_list_continues(sql, pos):
+    # True if a comma-separated FROM list continues beyond `pos`, e.g. after a JOIN condition
+    depth = 0
+    for token in _FROM_CLAUSE_TOKEN_RE.finditer(sql, pos):
+        token = token.group(0)
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+            if depth < 0:
+                return False
+        elif depth == 0:
+            return token == ','
+    return False
+
+
+def is_pure_read(sql):
+    """
+    Return True if `sql` is a SELECT statement which neither writes nor locks rows, and calls
+    only functions known to have no side effects, so that its result may be reused.
+    """
+    return (_READ_STATEMENT_RE.match(sql) is not None
+            and _WRITE_KEYWORD_RE.search(sql) is None
+            and all(name.lower() in _PURE_CALLS for name in _CALL_RE.findall(sql)))
+
+
+def written_tables(sql):
+    """
+    Return the names of the tables written by the statement `sql`, or None if unknown.
+
+    Only the tables named in the statement are returned: writes which it cascades to other tables
+    through foreign keys or triggers are not known, except for TRUNCATE ... CASCADE.
+    """
+    match = _WRITE_TABLES_RE.match(sql)
+    if match is None or _TRUNCATE_CASCADE_RE.match(sql):
+        return None
+    return _table_names(match.group(1))
+
+
+def _table_names(clause):
+    # Only the first identifier of each comma-separated item is a table; the rest are aliases.
+    names = set()
+    for item in clause.split(','):
+        item = re.sub(r'^\s*ONLY\s+', '', item, flags=re.IGNORECASE)
+        match = _IDENT_RE.search(item)
+        if match is not None:
+            names.add(normalise_table_name(match.group(0)))
+    return names
+
+
+def normalise_table_name(name):
+    """
+    Reduce a (possibly schema-qualified, possibly quoted) table name to its bare, unquoted,
+    lower-case form. Names in different schemas therefore collide, which errs on the side of
+    over-invalidation.
+    """
+    return name.rsplit('.', 1)[-1].strip('"').lower()
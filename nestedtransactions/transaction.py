@@ -1,7 +1,11 @@
 import logging
+import sys
 from collections import defaultdict
 
-from psycopg2.extensions import TRANSACTION_STATUS_INTRANS, TRANSACTION_STATUS_INERROR
+from psycopg2.extensions import TRANSACTION_STATUS_INTRANS, TRANSACTION_STATUS_INERROR, cursor
+
+from nestedtransactions.read_cache import (ReadCache, is_pure_read, normalise_table_name,
+                                           read_tables, written_tables)
 
 _log = logging.getLogger(__name__)
 _log.setLevel(logging.WARN)
@@ -25,14 +29,32 @@ class Transaction(object):
     """
     __transaction_stack = defaultdict(list)  # cxn -> [active_transaction_contexts]
 
-    def __init__(self, cxn, force_discard=False):
+    def __init__(self, cxn, force_discard=False, read_cache_size=None, profiler=None):
         """
         :param cxn: An open psycopg2 database connection.
         :param force_discard: If True, rollback changes even if the Transaction block exits
                               successfully.
+        :param read_cache_size: If set, cache up to this many results of `fetchall()` for the
+                                lifetime of the outermost Transaction. (Ignored for nested
+                                Transactions, which share the cache of the outermost one.)
+                                Requires REPEATABLE READ or SERIALIZABLE isolation. While
+                                active, `cxn.cursor_factory` is replaced so that statements
+                                executed through `cxn.cursor()` invalidate the cache.
+        :param profiler: A started `LockWaitProfiler` to attribute wait time of this Transaction
+                         and its nested Transactions to. (Ignored for nested Transactions, which
+                         are profiled if the outermost one is.)
         """
+        if read_cache_size is not None and read_cache_size < 1:
+            raise ValueError('read_cache_size must be a positive integer, got {!r}'
+                             .format(read_cache_size))
         self.cxn = cxn
         self._force_discard = force_discard
+        self._read_cache_size = read_cache_size
+        self._read_cache = None
+        self._original_cursor_factory = None
+        self._depth = None
+        self._profiler = profiler
+        self._entered_at = None
         self._rolled_back = False
         self._original_autocommit = None
         self._patched_originals = None
@@ -48,14 +70,35 @@ class Transaction(object):
 
             self._try_patch(self.cxn)
 
+            if self._read_cache_size is not None:
+                self._read_cache = ReadCache(self._read_cache_size)
+                self._original_cursor_factory = self.cxn.cursor_factory
+                self.cxn.cursor_factory = _read_cache_cursor_factory(
+                    self._original_cursor_factory or cursor)
+
         self._original_autocommit = self.cxn.autocommit
         if self.cxn.autocommit:
             self.cxn.autocommit = False
 
-        self._savepoint_id = 'savepoint_{}'.format(len(self._transaction_stack))
+        self._depth = len(self._transaction_stack)
+        self._savepoint_id = 'savepoint_{}'.format(self._depth)
+        profiler = (self._transaction_stack or [self])[0]._profiler
+        if profiler is not None:
+            caller = sys._getframe(1)
+            self._entered_at = '{}:{} in {}'.format(caller.f_code.co_filename, caller.f_lineno,
+                                                    caller.f_code.co_name)
         self._transaction_stack.append(self)
+        if profiler is not None and self._depth == 0:
+            profiler.register(self.cxn, self._transaction_stack)
 
         _execute_and_log(self.cxn, 'SAVEPOINT ' + self._savepoint_id)
+
+        if self._depth == 0 and self._read_cache_size is not None:
+            try:
+                self._check_read_cache_isolation_level()
+            except Exception:
+                self.__exit__(*sys.exc_info())
+                raise
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -67,12 +110,18 @@ class Transaction(object):
             elif not self._rolled_back:
                 self._commit()
 
+            if self._cache is not None:
+                self._cache.release(self._depth)
+
             assert self._transaction_stack.pop() is self, ('Out-of-order Transaction context '
                                                            'exits. Are you calling __exit__() '
                                                            'manually and getting it wrong?')
 
             if len(self._transaction_stack) == 0:
                 self._restore_patches(self.cxn)
+                if self._read_cache is not None:
+                    self._read_cache.invalidate()  # Hit/miss counters remain available
+                    self.cxn.cursor_factory = self._original_cursor_factory
                 del self.__transaction_stack[self.cxn]
                 if not self._containing_txn:
                     _log.info('%r: COMMIT', self.cxn)
@@ -85,6 +134,19 @@ class Transaction(object):
                 _log.error('Exception raised when trying to exit Transaction context. '
                            'Original exception:\n', exc_info=(exc_type, exc_val, exc_tb))
             raise
+        finally:
+            if self._depth == 0 and self._profiler is not None:
+                self._profiler.unregister(self.cxn)
+
+    def _check_read_cache_isolation_level(self):
+        # Under READ COMMITTED, changes committed by other sessions would be hidden by the cache
+        with self.cxn.cursor() as cur:
+            _execute_without_invalidation(cur, 'SHOW transaction_isolation')
+            isolation_level, = cur.fetchone()
+        if isolation_level not in ('repeatable read', 'serializable'):
+            raise Exception('Read cache requires REPEATABLE READ or SERIALIZABLE isolation, but '
+                            'the transaction isolation level is {}.'
+                            .format(isolation_level.upper()))
 
     def _commit(self):
         if self.cxn.get_transaction_status() == TRANSACTION_STATUS_INERROR:
@@ -108,11 +170,78 @@ class Transaction(object):
             raise Exception('Transaction already rolled back.')
         _execute_and_log(self.cxn, 'ROLLBACK TO SAVEPOINT ' + self._savepoint_id)
         self._rolled_back = True
+        if self._cache is not None:
+            self._cache.discard(self._depth)
+
+    def fetchall(self, sql, params=None, tables=None):
+        """
+        Execute a read query and return all result rows, serving repeated queries from the read
+        cache if one was enabled on the outermost Transaction (see `read_cache_size`).
+
+        Statements which may write or have other side effects (see `is_pure_read()`) are always
+        executed, and invalidate the read cache like any other statement executed through
+        `cxn.cursor()`.
+
+        :param tables: Names of the tables the query reads from. By default these are inferred
+                       from the FROM and JOIN clauses of `sql`; pass them explicitly for queries
+                       on views or functions whose underlying tables are not named in `sql`.
+        """
+        with self.cxn.cursor() as cur:
+            cache = self._cache
+            if cache is None or not is_pure_read(sql):
+                cur.execute(sql, params)
+                return cur.fetchall()
+
+            key = cur.mogrify(sql, params)
+            rows = cache.get(key)
+            if rows is None:
+                _execute_without_invalidation(cur, sql, params)
+                rows = cur.fetchall()
+                if tables is None:
+                    tables = read_tables(sql)
+                else:
+                    tables = set(normalise_table_name(t) for t in tables)
+                # Tag with the innermost scope, which may not be self, so that the entry is
+                # discarded if the scope whose changes it may reflect is rolled back
+                cache.put(key, rows, tables, len(self._transaction_stack) - 1)
+            return rows
+
+    def invalidate_read_cache(self, *tables):
+        """
+        Drop read cache entries read from any of `tables`, or all entries if no tables are given.
+
+        Statements executed through `cxn.cursor()` invalidate the cache automatically; this is
+        only needed after writing through a cursor created before the outermost Transaction was
+        entered, or with an explicit `cursor_factory` argument.
+        """
+        if self._cache is not None:
+            self._cache.invalidate(set(normalise_table_name(t) for t in tables) or None)
+
+    def cache_info(self):
+        """
+        Return a (hits, misses, maxsize, currsize) named tuple for the read cache, or None if the
+        read cache is not enabled.
+        """
+        cache = self._cache or self._read_cache
+        if cache is None:
+            return None
+        return cache.info()
 
     @property
     def _transaction_stack(self):
         return self.__transaction_stack[self.cxn]
 
+    @property
+    def _cache(self):
+        return self._read_cache_for(self.cxn)
+
+    @classmethod
+    def _read_cache_for(cls, cxn):
+        stack = cls.__transaction_stack.get(cxn)  # Avoid creating an entry if not active
+        if not stack:
+            return None
+        return stack[0]._read_cache
+
     def _try_patch(self, cxn):
         """
         Try to patch `cxn` methods to assert helpfully when called in the Transaction context.
@@ -153,4 +282,64 @@ class Transaction(object):
 def _execute_and_log(cxn, sql):
     with cxn.cursor() as cur:
         _log.info('%r: %s', cxn, sql)
-        cur.execute(sql)
+        _execute_without_invalidation(cur, sql)
+
+
+class _ReadCacheInvalidatingCursor(object):
+    """
+    Cursor mixin which invalidates the read cache of the active Transaction on the cursor's
+    connection before each statement which is not a pure read: for the tables written, if they
+    can be determined from the statement, otherwise entirely.
+    """
+
+    def execute(self, query, vars=None):
+        self._invalidate_read_cache_for(query)
+        return super(_ReadCacheInvalidatingCursor, self).execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        self._invalidate_read_cache_for(query)
+        return super(_ReadCacheInvalidatingCursor, self).executemany(query, vars_list)
+
+    def callproc(self, procname, *args, **kwargs):
+        self._invalidate_read_cache(None)
+        return super(_ReadCacheInvalidatingCursor, self).callproc(procname, *args, **kwargs)
+
+    def copy_from(self, file, table, *args, **kwargs):
+        self._invalidate_read_cache({normalise_table_name(table)})
+        return super(_ReadCacheInvalidatingCursor, self).copy_from(file, table, *args, **kwargs)
+
+    def copy_expert(self, sql, *args, **kwargs):
+        self._invalidate_read_cache(None)
+        return super(_ReadCacheInvalidatingCursor, self).copy_expert(sql, *args, **kwargs)
+
+    def _invalidate_read_cache(self, tables):
+        cache = Transaction._read_cache_for(self.connection)
+        if cache is not None:
+            cache.invalidate(tables)
+
+    def _invalidate_read_cache_for(self, query):
+        if hasattr(query, 'as_string'):  # psycopg2.sql.Composable
+            query = query.as_string(self)
+        if isinstance(query, bytes) and bytes is not str:
+            query = query.decode('utf-8', 'replace')
+        if not is_pure_read(query):
+            self._invalidate_read_cache(written_tables(query))
+
+
+_read_cache_cursor_factories = {}  # cursor_factory -> invalidating subclass
+
+
+def _read_cache_cursor_factory(cursor_factory):
+    if issubclass(cursor_factory, _ReadCacheInvalidatingCursor):
+        return cursor_factory
+    if cursor_factory not in _read_cache_cursor_factories:
+        _read_cache_cursor_factories[cursor_factory] = type(
+            'ReadCacheInvalidating' + cursor_factory.__name__,
+            (_ReadCacheInvalidatingCursor, cursor_factory), {})
+    return _read_cache_cursor_factories[cursor_factory]
+
+
+def _execute_without_invalidation(cur, sql, params=None):
+    if isinstance(cur, _ReadCacheInvalidatingCursor):
+        return super(_ReadCacheInvalidatingCursor, cur).execute(sql, params)
+    return cur.execute(sql, params)
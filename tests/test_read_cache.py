@@ -0,0 +1,77 @@
+import pytest
+
+from nestedtransactions.read_cache import is_pure_read, read_tables, written_tables
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT * FROM a', {'a'}),
+    ('SELECT * FROM a;', {'a'}),
+    ('select * from A', {'a'}),
+    ('SELECT * FROM public.a', {'a'}),
+    ('SELECT * FROM "Schema"."A"', {'a'}),
+    ('SELECT * FROM ONLY a', {'a'}),
+    ('SELECT * FROM a x, b AS y WHERE x.id = y.id', {'a', 'b'}),
+    ('SELECT * FROM a, ONLY b', {'a', 'b'}),
+    ('SELECT * FROM a x JOIN b ON (x.id = b.id) WHERE (1 = 1)', {'a', 'b'}),
+    ('SELECT * FROM a LEFT OUTER JOIN b y USING (id) ORDER BY 1', {'a', 'b'}),
+    ('SELECT * FROM a JOIN b ON f(a.x, b.y) WHERE g(1, 2)', {'a', 'b'}),
+    ('SELECT * FROM a WHERE x IN (SELECT y FROM b, c)', {'a', 'b', 'c'}),
+    ('SELECT * FROM a WHERE EXISTS (SELECT 1 FROM b WHERE b.id = a.id)', {'a', 'b'}),
+    ('SELECT count(*) FROM a GROUP BY x', {'a'}),
+    ('SELECT * FROM a, lateral_things l', {'a', 'lateral_things'}),
+    # Tables cannot be determined
+    ('SELECT 1', None),
+    ('SELECT * FROM my_func()', None),
+    ('SELECT * FROM a, LATERAL f(a.x)', None),
+    ('SELECT * FROM a JOIN LATERAL (SELECT 1) s ON true', None),
+    ('SELECT * FROM (SELECT * FROM a) s', None),
+    ('SELECT * FROM a AS x(c)', None),
+    ('SELECT * FROM ROWS FROM (f())', None),
+    ('SELECT * FROM a, (VALUES (1)) v(x), c', None),
+    ('SELECT * FROM a JOIN (SELECT * FROM b) s ON true, c', None),
+    ('SELECT * FROM a t1, b t2 TABLESAMPLE SYSTEM(1), c', None),
+    ('SELECT * FROM a JOIN b ON a.id = b.id, c', None),
+])
+def test_read_tables(sql, expected):
+    assert read_tables(sql) == expected
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('INSERT INTO a VALUES (1)', {'a'}),
+    ('insert into public.A (x, y) VALUES (1, 2)', {'a'}),
+    ('  UPDATE a SET x = 1', {'a'}),
+    ('UPDATE ONLY a SET x = 1', {'a'}),
+    ('DELETE FROM a USING b WHERE a.id = b.id', {'a'}),
+    ('TRUNCATE a', {'a'}),
+    ('TRUNCATE TABLE a, "B"', {'a', 'b'}),
+    ('TRUNCATE a RESTRICT', {'a'}),
+    # Tables cannot be determined
+    ('SELECT 1', None),
+    ('CREATE TABLE a (x INT)', None),
+    ('WITH d AS (DELETE FROM a RETURNING *) SELECT * FROM d', None),
+    ('COPY a FROM STDIN', None),
+    ('TRUNCATE a CASCADE', None),
+    ('TRUNCATE TABLE a, b RESTART IDENTITY CASCADE', None),
+])
+def test_written_tables(sql, expected):
+    assert written_tables(sql) == expected
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT * FROM a', True),
+    ('  select count(*), max(x) FROM a WHERE y IN (1, 2) AND NOT (z = 3)', True),
+    ('SELECT * FROM a WHERE EXISTS (SELECT 1 FROM b)', True),
+    ('WITH x AS (SELECT * FROM a) SELECT * FROM x', True),
+    ('SELECT x::varchar(10) FROM generate_series(1, 3) x', True),
+    ("SELECT nextval('s')", False),
+    ('SELECT my_func(x) FROM a', False),
+    ('SELECT * INTO b FROM a', False),
+    ('SELECT * FROM a FOR UPDATE', False),
+    ('SELECT * FROM a FOR KEY SHARE', False),
+    ('WITH d AS (DELETE FROM a RETURNING *) SELECT * FROM d', False),
+    ('UPDATE a SET x = 1 RETURNING x', False),
+    ('DELETE FROM a RETURNING x', False),
+    ('VALUES (1)', False),
+])
+def test_is_pure_read(sql, expected):
+    assert is_pure_read(sql) is expected
@@ -1,4 +1,6 @@
 import re
+import threading
+import time
 
 import psycopg2
 import pytest
@@ -6,6 +8,7 @@ import testing.postgresql
 from psycopg2 import InternalError
 from psycopg2.extensions import STATUS_READY, STATUS_IN_TRANSACTION, TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
 
+from nestedtransactions.profiler import LockWaitProfiler
 from nestedtransactions.transaction import Transaction
 
 
@@ -41,6 +44,11 @@ def python_cxn(db):
         yield cxn
 
 
+@pytest.fixture()
+def repeatable_read(cxn):
+    cxn.set_session(isolation_level='REPEATABLE READ')
+
+
 class PythonConnection(psycopg2.extensions.connection):
     pass
 
@@ -490,6 +498,300 @@ def test_context_manager_is_not_reentrant(cxn):
     assert_not_in_transaction(cxn)
 
 
+def test_read_cache_serves_repeated_queries(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        insert_row(cxn, 'a')
+        assert txn.fetchall('SELECT * FROM tmp_table') == [('a',)]
+        assert txn.fetchall('SELECT * FROM tmp_table') == [('a',)]
+        assert txn.cache_info() == (1, 1, 10, 1)
+    assert txn.cache_info() == (1, 1, 10, 0)
+
+
+def test_read_cache_serializable_isolation_allowed(cxn):
+    cxn.set_session(isolation_level='SERIALIZABLE')
+    with Transaction(cxn, read_cache_size=10) as txn:
+        assert txn.cache_info() is not None
+
+
+def test_read_cache_read_committed_isolation_raises(cxn):
+    with pytest.raises(Exception, match=re.escape('Read cache requires REPEATABLE READ or '
+                                                  'SERIALIZABLE isolation, but the transaction '
+                                                  'isolation level is READ COMMITTED.')):
+        with Transaction(cxn, read_cache_size=10):
+            pass
+    assert_not_in_transaction(cxn)
+    assert cxn.autocommit is True
+    assert cxn.cursor_factory is None
+    assert cxn not in Transaction._Transaction__transaction_stack
+
+
+def test_read_cache_read_committed_containing_transaction_raises(cxn, other_cxn):
+    cxn.autocommit = False
+    insert_row(cxn, 'prior')
+    with pytest.raises(Exception, match='Read cache requires REPEATABLE READ'):
+        with Transaction(cxn, read_cache_size=10):
+            pass
+    assert_rows(cxn, {'prior'}, still_in_transaction=True)
+    assert_rows(other_cxn, set())
+
+
+def test_read_cache_invalid_size_raises_without_patching_connection(python_cxn):
+    for size in (0, -1):
+        with pytest.raises(ValueError, match='read_cache_size must be a positive integer'):
+            Transaction(python_cxn, read_cache_size=size)
+    assert 'commit' not in python_cxn.__dict__
+    assert 'rollback' not in python_cxn.__dict__
+    python_cxn.commit()
+
+
+def test_read_cache_disabled_by_default(cxn):
+    with Transaction(cxn) as txn:
+        insert_row(cxn, 'a')
+        assert txn.fetchall('SELECT * FROM tmp_table') == [('a',)]
+        assert txn.cache_info() is None
+
+
+def test_read_cache_keyed_by_params(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        insert_row(cxn, 'a')
+        insert_row(cxn, 'b')
+        sql = 'SELECT * FROM tmp_table WHERE Id = %s'
+        assert txn.fetchall(sql, ('a',)) == [('a',)]
+        assert txn.fetchall(sql, ('b',)) == [('b',)]
+        assert txn.fetchall(sql, ('a',)) == [('a',)]
+        assert txn.cache_info() == (1, 2, 10, 2)
+
+
+def test_read_cache_invalidated_on_write_to_table(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        assert txn.fetchall('SELECT * FROM tmp_table') == []
+        insert_row(cxn, 'a')
+        assert txn.fetchall('SELECT * FROM tmp_table') == [('a',)]
+        assert txn.cache_info().hits == 0
+
+
+def test_read_cache_invalidated_on_write_in_nested_transaction(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        assert txn.fetchall('SELECT * FROM tmp_table') == []
+        with Transaction(cxn):
+            insert_row(cxn, 'inner')
+        assert txn.fetchall('SELECT * FROM tmp_table') == [('inner',)]
+
+
+def test_read_cache_not_invalidated_on_write_to_other_table(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        with cxn.cursor() as cur:
+            cur.execute('CREATE TEMPORARY TABLE other_table(Id INT)')
+        assert txn.fetchall('SELECT * FROM tmp_table') == []
+        with cxn.cursor() as cur:
+            cur.execute('INSERT INTO other_table VALUES (1)')
+        assert txn.fetchall('SELECT * FROM tmp_table') == []
+        assert txn.cache_info().hits == 1
+
+
+def test_read_cache_entries_selecting_from_functions_invalidated_on_any_write(cxn,
+                                                                              repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        txn.fetchall('SELECT * FROM generate_series(1, 3)')
+        txn.fetchall('SELECT * FROM tmp_table t, LATERAL generate_series(1, 3)')
+        txn.fetchall('SELECT * FROM generate_series(1, 3)', tables=['other_table'])
+        insert_row(cxn, 'a')
+        assert txn.cache_info().currsize == 1
+
+
+def test_read_cache_invalidated_entirely_on_unrecognised_statement(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        txn.fetchall('SELECT * FROM tmp_table')
+        with cxn.cursor() as cur:
+            cur.execute('CREATE TEMPORARY SEQUENCE tmp_sequence')
+        assert txn.cache_info().currsize == 0
+
+
+def test_read_cache_not_invalidated_on_pure_read_through_cursor(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        txn.fetchall('SELECT * FROM tmp_table')
+        with cxn.cursor() as cur:
+            cur.execute('SELECT count(*) FROM tmp_table')
+        assert txn.cache_info().currsize == 1
+        with cxn.cursor() as cur:
+            cur.execute('SELECT * FROM tmp_table FOR UPDATE')
+        assert txn.cache_info().currsize == 0
+
+
+def test_read_cache_cursor_factory_restored_after_transaction_block(cxn, repeatable_read):
+    original_cursor_factory = cxn.cursor_factory
+    with Transaction(cxn, read_cache_size=10):
+        assert cxn.cursor_factory is not original_cursor_factory
+    assert cxn.cursor_factory is original_cursor_factory
+
+
+def test_read_cache_explicit_invalidation(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        txn.fetchall('SELECT * FROM tmp_table')
+        txn.invalidate_read_cache('other_table')
+        assert txn.cache_info().currsize == 1
+        txn.invalidate_read_cache('TMP_TABLE')
+        assert txn.cache_info().currsize == 0
+
+
+def test_read_cache_not_used_for_writes(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        insert_row(cxn, 'a')
+        assert txn.fetchall('SELECT * FROM tmp_table') == [('a',)]
+        sql = "UPDATE tmp_table SET Id = Id || 'x' RETURNING Id"
+        assert txn.fetchall(sql) == [('ax',)]
+        assert txn.fetchall(sql) == [('axx',)]
+        assert txn.fetchall('SELECT * FROM tmp_table') == [('axx',)]
+        assert txn.cache_info().hits == 0
+
+
+def test_read_cache_not_used_for_volatile_function_calls(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as txn:
+        with cxn.cursor() as cur:
+            cur.execute('CREATE TEMPORARY SEQUENCE tmp_sequence')
+        assert txn.fetchall("SELECT nextval('tmp_sequence')") == [(1,)]
+        assert txn.fetchall("SELECT nextval('tmp_sequence')") == [(2,)]
+        assert txn.cache_info() == (0, 0, 10, 0)
+
+
+def test_read_cache_shared_with_nested_transactions(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as outer_txn:
+        outer_txn.fetchall('SELECT * FROM tmp_table')
+        with Transaction(cxn) as inner_txn:
+            inner_txn.fetchall('SELECT * FROM tmp_table')
+            assert inner_txn.cache_info() == (1, 1, 10, 1)
+
+
+def test_read_cache_inner_entries_discarded_on_inner_rollback(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as outer_txn:
+        with Transaction(cxn) as inner_txn:
+            insert_row(cxn, 'inner')
+            assert inner_txn.fetchall('SELECT * FROM tmp_table') == [('inner',)]
+            inner_txn.rollback()
+        assert outer_txn.cache_info().currsize == 0
+        assert outer_txn.fetchall('SELECT * FROM tmp_table') == []
+
+
+def test_read_cache_inner_entries_discarded_on_inner_exception(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as outer_txn:
+        with pytest.raises(ExpectedException):
+            with Transaction(cxn) as inner_txn:
+                insert_row(cxn, 'inner')
+                assert inner_txn.fetchall('SELECT * FROM tmp_table') == [('inner',)]
+                raise ExpectedException()
+        assert outer_txn.fetchall('SELECT * FROM tmp_table') == []
+
+
+def test_read_cache_entries_read_via_outer_transaction_discarded_on_inner_rollback(cxn,
+                                                                                   repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as outer_txn:
+        with Transaction(cxn) as inner_txn:
+            insert_row(cxn, 'inner')
+            assert outer_txn.fetchall('SELECT * FROM tmp_table') == [('inner',)]
+            inner_txn.rollback()
+        assert outer_txn.fetchall('SELECT * FROM tmp_table') == []
+        assert outer_txn.cache_info().hits == 0
+
+
+def test_read_cache_inner_entries_retained_on_inner_success_until_outer_rollback(cxn,
+                                                                                 repeatable_read):
+    with Transaction(cxn, read_cache_size=10) as outer_txn:
+        with Transaction(cxn) as middle_txn:
+            with Transaction(cxn) as inner_txn:
+                insert_row(cxn, 'inner')
+                inner_txn.fetchall('SELECT * FROM tmp_table')
+            assert middle_txn.cache_info().currsize == 1
+            middle_txn.rollback()
+        assert outer_txn.cache_info().currsize == 0
+
+
+def test_read_cache_evicts_least_recently_used(cxn, repeatable_read):
+    with Transaction(cxn, read_cache_size=2) as txn:
+        txn.fetchall('SELECT 1 FROM tmp_table')
+        txn.fetchall('SELECT 2 FROM tmp_table')
+        txn.fetchall('SELECT 1 FROM tmp_table')  # Hit; 2 is now least recently used
+        txn.fetchall('SELECT 3 FROM tmp_table')  # Evicts 2
+        txn.fetchall('SELECT 1 FROM tmp_table')
+        assert txn.cache_info() == (2, 3, 2, 2)
+        txn.fetchall('SELECT 2 FROM tmp_table')
+        assert txn.cache_info() == (2, 4, 2, 2)
+
+
+def test_profiler_attributes_lock_wait_to_innermost_scope(db, cxn, other_cxn):
+    other_cxn.autocommit = False
+    with other_cxn.cursor() as cur:
+        cur.execute('LOCK TABLE tmp_table IN ACCESS EXCLUSIVE MODE')
+
+    def release_once_wait_observed():
+        try:
+            _wait_for(lambda: _lock_wait(profiler, depth=1) >= 10 * profiler.interval)
+        finally:
+            other_cxn.rollback()
+
+    with LockWaitProfiler(interval=0.01, **db.dsn()) as profiler:
+        release = threading.Thread(target=release_once_wait_observed)
+        with Transaction(cxn, profiler=profiler):
+            with Transaction(cxn):
+                release.start()
+                insert_row(cxn, 'blocked')
+    release.join()
+
+    blocked = profiler.stats()[0]
+    assert blocked.depth == 1
+    assert blocked.location.startswith(__file__.rstrip('c'))
+    assert max(blocked.by_category, key=blocked.by_category.get) == 'Lock'
+    assert any('on tmp_table held by pid {}'.format(other_cxn.get_backend_pid()) in description
+               for description in blocked.blocked_on)
+    assert 'entered at ' + blocked.location in profiler.report()
+
+
+def test_profiler_attributes_client_time(db, cxn):
+    def client_time():
+        return sum(s.by_category.get('Client', 0) for s in profiler.stats())
+
+    with LockWaitProfiler(interval=0.01, **db.dsn()) as profiler:
+        with Transaction(cxn, profiler=profiler):
+            insert_row(cxn, 'value')
+            _wait_for(lambda: client_time() >= 10 * profiler.interval)  # Client-side work
+
+    [scope] = profiler.stats()
+    assert scope.depth == 0
+    assert scope.lock_wait == 0
+    assert max(scope.by_category, key=scope.by_category.get) == 'Client'
+
+
+def test_profiler_report_marked_incomplete_after_sampling_failure(db, cxn):
+    with LockWaitProfiler(interval=0.01, **db.dsn()) as profiler:
+        with Transaction(cxn, profiler=profiler):
+            profiler._sample = None  # Make the next sample fail
+            _wait_for(lambda: profiler.error is not None)
+
+    assert isinstance(profiler.error, TypeError)
+    assert profiler.report().startswith('INCOMPLETE: sampling stopped early after error: ')
+
+
+def test_profiler_unregistered_when_outermost_exit_fails(db, cxn):
+    profiler = LockWaitProfiler(**db.dsn())  # Not started; only registration is under test
+    txn = Transaction(cxn, profiler=profiler).__enter__()
+    assert profiler._backends
+    with pytest.raises(psycopg2.ProgrammingError):
+        cxn.cursor().execute('SELECT * FROM this_table_does_not_exist')
+    with pytest.raises(Exception, match='SQL error occurred within current transaction'):
+        txn.__exit__(None, None, None)
+    assert profiler._backends == {}
+
+
+def _lock_wait(profiler, depth):
+    return sum(s.lock_wait for s in profiler.stats() if s.depth == depth)
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'Timed out'
+        time.sleep(0.01)
+
+
 def insert_row(cxn, value):
     with cxn.cursor() as cur:
         cur.execute('INSERT INTO tmp_table VALUES (%s)', (value,))